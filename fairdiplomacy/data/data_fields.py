@@ -20,6 +20,17 @@ class DataFields(dict):
         else:
             return cls()
 
+    @classmethod
+    def cat_preallocated(cls, L: list):
+        """Same as cat, but sizes each output up front and concatenates into it.
+
+        Meant for collating many per-game DataFields into a dataset.
+        """
+        if len(L) > 0:
+            return cls({k: _cat_preallocated([x[k] for x in L]) for k in L[0]})
+        else:
+            return cls()
+
     @classmethod
     def stack(cls, L: list, dim: int = 0):
         if len(L) > 0:
@@ -37,6 +48,11 @@ class DataFields(dict):
             self[f] = self[f].to(torch.float32)
         return self
 
+    def pin_memory(self):
+        return DataFields(
+            {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in self.items()}
+        )
+
     def to(self, *args, **kwargs):
         return DataFields(
             {k: v.to(*args, **kwargs) if hasattr(v, "to") else v for k, v in self.items()}
@@ -45,3 +61,12 @@ class DataFields(dict):
 
 def _cat(x):
     return TensorList.cat(x) if isinstance(x[0], TensorList) else torch.cat(x)
+
+
+def _cat_preallocated(x):
+    if isinstance(x[0], TensorList):
+        lengths = _cat_preallocated([t.lengths() for t in x])
+        offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(0)])
+        return TensorList(offsets, _cat_preallocated([t.data for t in x]))
+    out = x[0].new_empty((sum(t.shape[0] for t in x),) + x[0].shape[1:])
+    return torch.cat(x, out=out)
@@ -3,13 +3,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
 import json
 import logging
 import os
 from itertools import combinations, product
-from typing import Any, Dict, Union, List, Optional, Sequence, Tuple
+from typing import Any, Dict, Iterator, Union, List, Optional, Sequence, Tuple
 
-import joblib
 import torch
 import numpy as np
 
@@ -31,6 +31,33 @@ from fairdiplomacy.utils.order_idxs import (
 
 LOC_IDX = {loc: idx for idx, loc in enumerate(LOCS)}
 
+# LOCS index of the acting unit of each order in ORDER_VOCABULARY, used to sort
+# orders in topo order. Combined build orders use their first unit.
+_ORDER_TOPO = np.fromiter(
+    (LOC_IDX[order.split()[1]] for order in ORDER_VOCABULARY),
+    dtype=np.int16,
+    count=len(ORDER_VOCABULARY),
+)
+
+# Maps the set of single build orders of each (combined) build order in
+# ORDER_VOCABULARY to its idx, so that build combos can be looked up without
+# sorting and joining them.
+_BUILD_COMBO_IDX = {
+    frozenset(order.split(";")): idx
+    for idx, order in enumerate(ORDER_VOCABULARY)
+    if order.endswith(" B")
+}
+
+# Number of encoded games that Dataset.preprocess collates at a time.
+_COLLATE_BATCH_SIZE = 1000
+
+# State of the mp_encode_games workers. The inputs are set by the parent before
+# forking the workers (or passed to _init_encode_worker if they aren't forked),
+# and each worker sets up its encoder in _init_encode_worker.
+_WORKER_ENCODER = None
+_WORKER_GAME_METADATA = None
+_WORKER_ENCODE_KWARGS = None
+
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(
@@ -47,6 +74,8 @@ class Dataset(torch.utils.data.Dataset):
         n_cf_agent_samples=1,
         min_rating=None,
         exclude_n_holds=-1,
+        pin_memory=False,
+        encoding_cache_dir=None,
     ):
         self.game_ids = game_ids
         self.data_dir = data_dir
@@ -59,6 +88,8 @@ class Dataset(torch.utils.data.Dataset):
         self.n_cf_agent_samples = n_cf_agent_samples
         self.min_rating = min_rating
         self.exclude_n_holds = exclude_n_holds
+        self.pin_memory = pin_memory
+        self.encoding_cache_dir = encoding_cache_dir
         # Pre-processing populates these fields
         self.game_idxs = None
         self.phase_idxs = None
@@ -74,23 +105,74 @@ class Dataset(torch.utils.data.Dataset):
     def preprocessed(self):
         return self._preprocessed
 
-    def mp_encode_games(self) -> List[Tuple]:
-        encoded_game_tuples = joblib.Parallel(n_jobs=self.n_jobs)(
-            joblib.delayed(encode_game)(
-                game_id=game_id,
-                data_dir=self.data_dir,
-                only_with_min_final_score=self.only_with_min_final_score,
-                cf_agent=self.cf_agent,
-                n_cf_agent_samples=self.n_cf_agent_samples,
-                value_decay_alpha=self.value_decay_alpha,
-                input_valid_power_idxs=self.get_valid_power_idxs(game_id),
-                game_metadata=self.game_metadata[game_id],
-                exclude_n_holds=self.exclude_n_holds,
-            )
-            for game_id in self.game_ids
+    def mp_encode_games(self) -> Iterator[Tuple]:
+        # Same meaning as joblib's n_jobs: -1 is all CPUs, -2 all but one, etc.
+        if self.n_jobs == 0:
+            raise ValueError("num_dataloader_workers must not be 0")
+        n_procs = self.n_jobs if self.n_jobs > 0 else max(os.cpu_count() + 1 + self.n_jobs, 1)
+
+        encode_kwargs = dict(
+            data_dir=self.data_dir,
+            only_with_min_final_score=self.only_with_min_final_score,
+            cf_agent=self.cf_agent,
+            n_cf_agent_samples=self.n_cf_agent_samples,
+            value_decay_alpha=self.value_decay_alpha,
+            min_rating=self.min_rating,
+            exclude_n_holds=self.exclude_n_holds,
+            # Datasets pickled before the cache was added don't have the attribute.
+            encoding_cache_dir=getattr(self, "encoding_cache_dir", None),
         )
+        if encode_kwargs["encoding_cache_dir"] is not None and self.cf_agent is not None:
+            # There is no stable key for an agent, and its samples are random anyway.
+            logging.warning("Not using the encoding cache, as games are encoded with a cf_agent")
+            encode_kwargs["encoding_cache_dir"] = None
+        if encode_kwargs["encoding_cache_dir"] is not None:
+            encode_kwargs["encoding_cache_dir"] = get_encoding_cache_subdir(
+                encode_kwargs["encoding_cache_dir"], encode_kwargs
+            )
+            os.makedirs(encode_kwargs["encoding_cache_dir"], exist_ok=True)
 
-        return encoded_game_tuples
+        # Workers read the metadata and encode kwargs from module globals. Forked
+        # workers inherit them copy-on-write, instead of each getting a pickled copy.
+        _set_encode_worker_inputs(self.game_metadata, encode_kwargs)
+        try:
+            if n_procs == 1:
+                _init_encode_worker()
+                for game_id in self.game_ids:
+                    yield _encode_game_in_worker(game_id)
+                return
+
+            # Workers are persistent: each builds a single FeatureEncoder, and games
+            # are streamed in chunks. torch.multiprocessing sends the encoded tensors
+            # back through shared memory rather than pickling their data.
+            chunksize = max(1, len(self.game_ids) // (4 * n_procs))
+            if self.cf_agent is None:
+                ctx, initargs = torch.multiprocessing.get_context("fork"), ()
+            else:
+                # The cf_agent may hold a CUDA model, which can't be used in a forked
+                # child, so these workers get the inputs pickled once via initargs.
+                ctx = torch.multiprocessing.get_context("forkserver")
+                game_metadata = {game_id: self.game_metadata[game_id] for game_id in self.game_ids}
+                initargs = (game_metadata, encode_kwargs)
+            with ctx.Pool(n_procs, initializer=_init_encode_worker, initargs=initargs) as pool:
+                yield from pool.imap(_encode_game_in_worker, self.game_ids, chunksize=chunksize)
+        finally:
+            _set_encode_worker_inputs(None, None)
+
+    def build_encoding_cache(self, out_dir: str):
+        """Encodes all games and saves them to out_dir, one file per game.
+
+        The dataset (and any other one with encoding_cache_dir=out_dir) then loads
+        encoded games from there instead of parsing the game jsons. Games are saved
+        in a subdir per set of encoding params (min_rating, value_decay_alpha, ...),
+        so datasets with other params don't reuse them. Games encoded with a
+        cf_agent can't be cached.
+        """
+        if self.cf_agent is not None:
+            raise ValueError("Can't cache games encoded with a cf_agent")
+        self.encoding_cache_dir = out_dir
+        for _ in self.mp_encode_games():
+            pass
 
     def preprocess(self):
         """
@@ -106,49 +188,50 @@ class Dataset(torch.utils.data.Dataset):
         )
 
         torch.set_num_threads(1)
-        encoder = FeatureEncoder()
-        encoded_game_tuples = self.mp_encode_games()
-
-        encoded_games = [
-            g for (_, g) in encoded_game_tuples if g is not None
-        ]  # remove "empty" games (e.g. json didn't exist)
-
-        logging.info(f"Found data for {len(encoded_games)} / {len(self.game_ids)} games")
-
-        encoded_games = [g for g in encoded_games if g["valid_power_idxs"][0].any()]
-        logging.info(f"{len(encoded_games)} games had data for at least one power")
+        # Collate games in batches as they arrive, so that the shared memory
+        # blocks of the games received from the workers are released as we go.
+        game_ids, game_lens, collated_batches, batch = [], [], [], []
+        num_found_games = 0
+        for game_id, encoded_game in self.mp_encode_games():
+            if encoded_game is None:
+                continue  # remove "empty" games (e.g. json didn't exist)
+            num_found_games += 1
+            if not encoded_game["valid_power_idxs"][0].any():
+                continue
+            game_ids.append(game_id)
+            game_lens.append(len(encoded_game["valid_power_idxs"]))
+            batch.append(encoded_game)
+            if len(batch) == _COLLATE_BATCH_SIZE:
+                collated_batches.append(DataFields.cat_preallocated(batch))
+                batch = []
+        if batch:
+            collated_batches.append(DataFields.cat_preallocated(batch))
+
+        logging.info(f"Found data for {num_found_games} / {len(self.game_ids)} games")
+        logging.info(f"{len(game_ids)} games had data for at least one power")
 
         # Update game_ids
-        self.game_ids = [
-            g_id
-            for (g_id, g) in encoded_game_tuples
-            if g_id is not None and g["valid_power_idxs"][0].any()
-        ]
-
-        game_idxs, phase_idxs, power_idxs, x_idxs = [], [], [], []
-        x_idx = 0
-        for game_idx, encoded_game in enumerate(encoded_games):
-            for phase_idx, valid_power_idxs in enumerate(encoded_game["valid_power_idxs"]):
-                assert valid_power_idxs.nelement() == len(POWERS), (
-                    encoded_game["valid_power_idxs"].shape,
-                    valid_power_idxs.shape,
-                )
-                for power_idx in valid_power_idxs.nonzero()[:, 0]:
-                    game_idxs.append(game_idx)
-                    phase_idxs.append(phase_idx)
-                    power_idxs.append(power_idx)
-                    x_idxs.append(x_idx)
-                x_idx += 1
-
-        self.game_idxs = torch.tensor(game_idxs, dtype=torch.long)
-        self.phase_idxs = torch.tensor(phase_idxs, dtype=torch.long)
-        self.power_idxs = torch.tensor(power_idxs, dtype=torch.long)
-        self.x_idxs = torch.tensor(x_idxs, dtype=torch.long)
+        self.game_ids = game_ids
 
         # now collate the data into giant tensors!
-        self.encoded_games = DataFields.cat(encoded_games)
-
-        self.num_games = len(encoded_games)
+        self.encoded_games = DataFields.cat_preallocated(collated_batches)
+
+        # index all valid (phase, power) pairs, ordered by game, phase, power
+        if game_ids:
+            valid_power_idxs = self.encoded_games["valid_power_idxs"]
+        else:
+            valid_power_idxs = torch.zeros((0, len(POWERS)), dtype=torch.bool)
+        assert valid_power_idxs.shape[1:] == (len(POWERS),), valid_power_idxs.shape
+        game_lens = torch.from_numpy(np.fromiter(game_lens, dtype=np.int64, count=len(game_lens)))
+        game_offsets = game_lens.cumsum(0) - game_lens
+
+        self.x_idxs, self.power_idxs = valid_power_idxs.nonzero(as_tuple=True)
+        # game idx of every phase, indexed by x_idx
+        phase_game_idxs = torch.repeat_interleave(torch.arange(len(game_lens)), game_lens)
+        self.game_idxs = phase_game_idxs[self.x_idxs]
+        self.phase_idxs = self.x_idxs - game_offsets[self.game_idxs]
+
+        self.num_games = len(game_ids)
         self.num_phases = len(self.encoded_games["x_board_state"]) if self.encoded_games else 0
         self.num_elements = len(self.x_idxs)
 
@@ -167,9 +250,7 @@ class Dataset(torch.utils.data.Dataset):
         return f"Dataset: {self.num_games} games, {self.num_phases} phases, and {self.num_elements} elements."
 
     def get_valid_power_idxs(self, game_id):
-        return [
-            self.game_metadata[game_id][pwr]["logit_rating"] >= self.min_rating for pwr in POWERS
-        ]
+        return get_valid_power_idxs(self.game_metadata[game_id], self.min_rating)
 
     def __getitem__(self, idx: Union[int, torch.Tensor]):
         assert self._preprocessed, "Dataset has not been pre-processed."
@@ -188,13 +269,11 @@ class Dataset(torch.utils.data.Dataset):
 
         fields = self.encoded_games.select(x_idx)  # [x[x_idx] for x in self.encoded_games[:-1]]
 
-        # unpack the possible_actions
-        possible_actions_idx = ((x_idx * len(POWERS) + power_idx) * MAX_SEQ_LEN).unsqueeze(
-            1
-        ) + torch.arange(MAX_SEQ_LEN).unsqueeze(0)
-        x_possible_actions = self.encoded_games["x_possible_actions"][
-            possible_actions_idx.view(-1)
-        ]
+        # unpack the possible_actions: the MAX_SEQ_LEN rows of each (phase, power)
+        # are stored contiguously
+        x_possible_actions = self.encoded_games["x_possible_actions"].select_blocks(
+            x_idx * len(POWERS) + power_idx, MAX_SEQ_LEN
+        )
         x_possible_actions_padded = x_possible_actions.to_padded(
             total_length=MAX_VALID_LEN, padding_value=EOS_IDX
         )
@@ -213,15 +292,22 @@ class Dataset(torch.utils.data.Dataset):
             .squeeze(1)
         )
 
-        # cast fields
-        for k in fields:
-            if isinstance(fields[k], torch.Tensor):
-                if k in ("x_possible_actions", "y_actions", "x_prev_orders"):
-                    fields[k] = fields[k].to(torch.long)
-                elif k != "prev_orders":
-                    fields[k] = fields[k].to(torch.float32)
+        # cast fields, skipping those that already have the right dtype
+        for k, v in fields.items():
+            if not isinstance(v, torch.Tensor) or k == "prev_orders":
+                continue
+            if k in ("x_possible_actions", "y_actions", "x_prev_orders"):
+                dtype = torch.long
+            else:
+                dtype = torch.float32
+            if v.dtype != dtype:
+                fields[k] = v.to(dtype)
 
-        return fields.from_storage_fmt_()
+        fields = fields.from_storage_fmt_()
+        # Datasets pickled before pin_memory was added don't have the attribute.
+        if getattr(self, "pin_memory", False):
+            fields = fields.pin_memory()
+        return fields
 
     def __len__(self):
         return self.num_elements * self.n_cf_agent_samples
@@ -250,7 +336,7 @@ class Dataset(torch.utils.data.Dataset):
         merged.phase_idxs = torch.cat([d.phase_idxs for d in datasets])
         merged.power_idxs = torch.cat([d.power_idxs for d in datasets])
         merged.x_idxs = torch.cat([d.x_idxs + off for d, off in zip(datasets, phase_offsets)])
-        merged.encoded_games = DataFields.cat([d.encoded_games for d in datasets])
+        merged.encoded_games = DataFields.cat_preallocated([d.encoded_games for d in datasets])
         merged.num_games = sum(d.num_games for d in datasets)
         merged.num_phases = sum(d.num_phases for d in datasets)
         merged.num_elements = sum(d.num_elements for d in datasets)
@@ -259,6 +345,93 @@ class Dataset(torch.utils.data.Dataset):
         return merged
 
 
+def get_valid_power_idxs(game_metadata, min_rating) -> List[bool]:
+    return [game_metadata[pwr]["logit_rating"] >= min_rating for pwr in POWERS]
+
+
+def _set_encode_worker_inputs(game_metadata, encode_kwargs):
+    global _WORKER_GAME_METADATA, _WORKER_ENCODE_KWARGS
+    _WORKER_GAME_METADATA = game_metadata
+    _WORKER_ENCODE_KWARGS = encode_kwargs
+
+
+def _init_encode_worker(*worker_inputs):
+    """Sets up a worker. Workers that aren't forked get their inputs as arguments."""
+    global _WORKER_ENCODER
+    if worker_inputs:
+        _set_encode_worker_inputs(*worker_inputs)
+    torch.set_num_threads(1)
+    _WORKER_ENCODER = FeatureEncoder()
+
+
+def _encode_game_in_worker(game_id):
+    kwargs = dict(_WORKER_ENCODE_KWARGS)
+    min_rating = kwargs.pop("min_rating")
+    encoding_cache_dir = kwargs.pop("encoding_cache_dir")
+    if encoding_cache_dir is not None:
+        cache_path = get_encoding_cache_path(encoding_cache_dir, game_id)
+        if os.path.exists(cache_path):
+            return game_id, _load_cached_encoding(cache_path)
+
+    game_metadata = _WORKER_GAME_METADATA[game_id]
+    encoded_game_tuple = encode_game(
+        game_id,
+        input_valid_power_idxs=get_valid_power_idxs(game_metadata, min_rating),
+        game_metadata=game_metadata,
+        encoder=_WORKER_ENCODER,
+        **kwargs,
+    )
+
+    if encoding_cache_dir is not None and encoded_game_tuple[1] is not None:
+        _save_cached_encoding(cache_path, encoded_game_tuple[1])
+    return encoded_game_tuple
+
+
+def _save_cached_encoding(cache_path: str, data_fields: DataFields) -> None:
+    # Saved as plain tensors rather than pickled DataFields/TensorList objects, so
+    # that torch.load can read them back with weights_only (the default in torch 2).
+    state = {
+        k: {"offsets": v.offsets, "data": v.data} if isinstance(v, TensorList) else v
+        for k, v in data_fields.items()
+    }
+    # write to a tmp file first so that a crash never leaves a partial cache entry
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def _load_cached_encoding(cache_path: str) -> DataFields:
+    state = torch.load(cache_path)
+    return DataFields(
+        {
+            k: TensorList(v["offsets"], v["data"]) if isinstance(v, dict) else v
+            for k, v in state.items()
+        }
+    )
+
+
+def get_encoding_cache_subdir(encoding_cache_dir: str, encode_kwargs: Dict) -> str:
+    """Returns the subdir of encoding_cache_dir for games encoded with encode_kwargs.
+
+    The subdir name is a hash of the params. Games encoded with a cf_agent are
+    not cached, as the agent has no stable key.
+    """
+    assert encode_kwargs.get("cf_agent") is None, "Can't cache games encoded with a cf_agent"
+    params = sorted((k, v) for k, v in encode_kwargs.items() if k != "encoding_cache_dir")
+    params_hash = hashlib.md5(repr(params).encode()).hexdigest()[:8]
+    return os.path.join(encoding_cache_dir, f"params_{params_hash}")
+
+
+def get_encoding_cache_path(encoding_cache_dir: str, game_id: Union[int, str]) -> str:
+    if isinstance(game_id, str):
+        # game_id is a path to the game json. Add a hash of the full path, as jsons
+        # in different dirs may share the same name.
+        stem = os.path.splitext(os.path.basename(game_id))[0]
+        path_hash = hashlib.md5(game_id.encode()).hexdigest()[:8]
+        return os.path.join(encoding_cache_dir, f"{stem}_{path_hash}.pt")
+    return os.path.join(encoding_cache_dir, f"game_{game_id}.pt")
+
+
 def encode_game(
     game_id: Union[int, str],
     data_dir: str,
@@ -270,6 +443,7 @@ def encode_game(
     value_decay_alpha,
     game_metadata,
     exclude_n_holds,
+    encoder: Optional[FeatureEncoder] = None,
 ):
     """
     Arguments:
@@ -279,6 +453,7 @@ def encode_game(
       winners). MILA uses 7.
     - input_valid_power_idxs: bool tensor, true if power should a priori be included in
       the dataset based on e.g. player rating)
+    - encoder: FeatureEncoder to reuse across games. A new one is created if None.
     Return: game_id, DataFields dict of tensors:
     L is game length, P is # of powers above min_final_score, N is n_cf_agent_samples
     - board_state: shape=(L, 81, 35)
@@ -295,8 +470,9 @@ def encode_game(
     - valid_power_idxs: shape=(L, 7) bool mask of valid powers at each phase
     """
 
-    torch.set_num_threads(1)
-    encoder = FeatureEncoder()
+    if encoder is None:
+        torch.set_num_threads(1)
+        encoder = FeatureEncoder()
 
     if isinstance(game_id, str):
         game_path = game_id
@@ -310,15 +486,41 @@ def encode_game(
         print(f"Error while loading game at {game_path}: {e}")
         return None, None
 
-    num_phases = len(game.get_phase_history())
+    phases = game.get_phase_history()
+    phase_names = [phase.name for phase in phases]
+    num_phases = len(phase_names)
     logging.info(f"Encoding {game.game_id} with {num_phases} phases")
 
+    # Roll back one phase at a time starting from the end of the game, so that
+    # each rollback truncates the previous (already shorter) game.
+    rolled_back_games = [None] * num_phases
+    rolled_back_game = game
+    for phase_idx in reversed(range(num_phases)):
+        rolled_back_game = rolled_back_game.rolled_back_to_phase_start(phase_names[phase_idx])
+        rolled_back_games[phase_idx] = rolled_back_game
+
+    # encode the inputs of all phases in a single call
+    data_fields = encoder.encode_inputs(rolled_back_games)
+
+    # score every phase once, rather than all future phases for each phase. With
+    # value_decay_alpha == 1 only the last phase is needed (see
+    # encode_weighted_sos_scores).
+    all_sq_scores, end_of_year_mask = encode_all_sq_scores(
+        phases, last_phase_only=value_decay_alpha == 1.0
+    )
+    final_sq_scores = torch.FloatTensor(game.get_square_scores())
+
     phase_encodings = [
         encode_phase(
-            encoder,
             game,
             game_id,
             phase_idx,
+            phase=phases[phase_idx],
+            rolled_back_game=rolled_back_games[phase_idx],
+            data_fields=data_fields.select(slice(phase_idx, phase_idx + 1)),
+            all_sq_scores=all_sq_scores,
+            end_of_year_mask=end_of_year_mask,
+            final_sq_scores=final_sq_scores,
             only_with_min_final_score=only_with_min_final_score,
             cf_agent=cf_agent,
             n_cf_agent_samples=n_cf_agent_samples,
@@ -335,11 +537,16 @@ def encode_game(
 
 
 def encode_phase(
-    encoder: FeatureEncoder,
     game: Game,
     game_id: str,
     phase_idx: int,
     *,
+    phase,
+    rolled_back_game: Game,
+    data_fields: DataFields,
+    all_sq_scores: torch.Tensor,
+    end_of_year_mask: torch.Tensor,
+    final_sq_scores: torch.Tensor,
     only_with_min_final_score: Optional[int],
     cf_agent=None,
     n_cf_agent_samples=1,
@@ -352,23 +559,28 @@ def encode_phase(
     - game: Game object
     - game_id: unique id for game
     - phase_idx: int, the index of the phase to encode
+    - phase: the phase_idx-th entry of game.get_phase_history()
+    - rolled_back_game: game rolled back to the start of the phase
+    - data_fields: encoded inputs of rolled_back_game, with a batch dim of 1
+    - all_sq_scores, end_of_year_mask, final_sq_scores: square scores of the
+      game, see encode_weighted_sos_scores
     - only_with_min_final_score: if specified, only encode for powers who
       finish the game with some # of supply centers (i.e. only learn from
       winners). MILA uses 7.
 
     Returns: DataFields, including y_actions and y_final_score
     """
-    phase = game.get_phase_history()[phase_idx]
-    rolled_back_game = game.rolled_back_to_phase_start(phase.name)
-    data_fields = encoder.encode_inputs([rolled_back_game])
-
     # encode final scores
-    y_final_scores = encode_weighted_sos_scores(game, phase_idx, value_decay_alpha)
+    y_final_scores = encode_weighted_sos_scores(
+        all_sq_scores, end_of_year_mask, final_sq_scores, phase_idx, value_decay_alpha
+    )
 
     # encode actions
     valid_power_idxs = torch.tensor(input_valid_power_idxs, dtype=torch.bool)
     # print('valid_power_idxs', valid_power_idxs)
-    y_actions_lst = []
+    y_actions = torch.full(
+        (len(POWERS), n_cf_agent_samples, MAX_SEQ_LEN), EOS_IDX, dtype=torch.int32
+    )  # [7, N, 17]
     power_orders_samples = (
         {power: [phase.orders.get(power, [])] for power in POWERS}
         if cf_agent is None
@@ -378,23 +590,15 @@ def encode_phase(
         orders_samples = power_orders_samples[power]
         if len(orders_samples) == 0:
             valid_power_idxs[power_i] = False
-            y_actions_lst.append(
-                torch.empty(n_cf_agent_samples, MAX_SEQ_LEN, dtype=torch.int32).fill_(EOS_IDX)
-            )
             continue
-        encoded_power_actions_lst = []
-        for orders in orders_samples:
-            encoded_power_actions, valid = encode_power_actions(
-                orders, data_fields["x_possible_actions"][0, power_i]
-            )
-            encoded_power_actions_lst.append(encoded_power_actions)
+        x_possible_actions = data_fields["x_possible_actions"][0, power_i]
+        for sample_i, orders in enumerate(orders_samples):
+            encoded_power_actions, valid = encode_power_actions(orders, x_possible_actions)
+            y_actions[power_i, sample_i] = encoded_power_actions
             if 0 <= exclude_n_holds <= len(orders):
                 if all(o.endswith(" H") for o in orders):
                     valid = 0
             valid_power_idxs[power_i] &= valid
-        y_actions_lst.append(torch.stack(encoded_power_actions_lst, dim=0))  # [N, 17]
-
-    y_actions = torch.stack(y_actions_lst, dim=0)  # [7, N, 17]
 
     # filter away powers that have no orders
     valid_power_idxs &= (y_actions != EOS_IDX).any(dim=2).all(dim=1)
@@ -449,7 +653,7 @@ def get_valid_orders_impl(power, all_possible_orders, all_orderable_locations, g
     # are from a coastal fleet
     orderable_locs = sorted(
         all_orderable_locations[power],
-        key=lambda loc: LOCS.index(all_possible_orders[loc][0].split()[1]),
+        key=lambda loc: LOC_IDX[all_possible_orders[loc][0].split()[1]],
     )
 
     power_possible_orders = [x for loc in orderable_locs for x in all_possible_orders[loc]]
@@ -458,14 +662,17 @@ def get_valid_orders_impl(power, all_possible_orders, all_orderable_locations, g
     if n_builds > 0:
         # build phase: represented as a single ;-separated string combining all
         # units to be built.
-        orders = [
-            ";".join(sorted(x))
-            for c in combinations([all_possible_orders[loc] for loc in orderable_locs], n_builds)
-            for x in product(*c)
-        ]
-        order_idxs = torch.tensor([ORDER_VOCABULARY_TO_IDX[x] for x in orders], dtype=torch.int32)
+        loc_possible_orders = [all_possible_orders[loc] for loc in orderable_locs]
+        order_idxs = torch.tensor(
+            [
+                _BUILD_COMBO_IDX[frozenset(x)]
+                for c in combinations(loc_possible_orders, n_builds)
+                for x in product(*c)
+            ],
+            dtype=torch.int32,
+        )
         all_order_idxs[0, :1, : len(order_idxs)] = order_idxs.sort().values.unsqueeze(0)
-        loc_idxs[0, [LOCS.index(l) for l in orderable_locs]] = -2
+        loc_idxs[0, [LOC_IDX[l] for l in orderable_locs]] = -2
         return all_order_idxs, loc_idxs, n_builds
 
     if n_builds < 0:
@@ -473,14 +680,14 @@ def get_valid_orders_impl(power, all_possible_orders, all_orderable_locations, g
         n_disbands = -n_builds
         _, order_idxs = filter_orders_in_vocab(power_possible_orders)
         all_order_idxs[0, :n_disbands, : len(order_idxs)] = order_idxs.sort().values.unsqueeze(0)
-        loc_idxs[0, [LOCS.index(l) for l in orderable_locs]] = -2
+        loc_idxs[0, [LOC_IDX[l] for l in orderable_locs]] = -2
         return all_order_idxs, loc_idxs, n_disbands
 
     # move phase: iterate through orderable_locs in topo order
     for i, loc in enumerate(orderable_locs):
         orders, order_idxs = filter_orders_in_vocab(all_possible_orders[loc])
         all_order_idxs[0, i, : len(order_idxs)] = order_idxs.sort().values
-        loc_idxs[0, LOCS.index(loc)] = i
+        loc_idxs[0, LOC_IDX[loc]] = i
 
     return all_order_idxs, loc_idxs, len(orderable_locs)
 
@@ -519,12 +726,13 @@ def encode_power_actions(orders: List[str], x_possible_actions) -> Tuple[torch.L
     y_actions = torch.empty(MAX_SEQ_LEN, dtype=torch.int32).fill_(EOS_IDX)
     order_idxs = []
 
-    if any(len(order.split()) < 3 for order in orders):
+    split_orders = [order.split() for order in orders]
+    if any(len(split_order) < 3 for split_order in split_orders):
         # skip over power with unparseably short order
         return y_actions, False
-    elif any(order.split()[2] == "B" for order in orders):
+    elif any(split_order[2] == "B" for split_order in split_orders):
         # builds are represented as a single ;-separated order
-        assert all(order.split()[2] == "B" for order in orders), orders
+        assert all(split_order[2] == "B" for split_order in split_orders), orders
         order = ";".join(sorted(orders))
         try:
             order_idx = ORDER_VOCABULARY_TO_IDX[order]
@@ -541,19 +749,23 @@ def encode_power_actions(orders: List[str], x_possible_actions) -> Tuple[torch.L
                 continue
 
     # sort by topo order
-    order_idxs.sort(key=lambda idx: LOCS.index(ORDER_VOCABULARY[idx].split()[1]))
-    for i, order_idx in enumerate(order_idxs):
-        try:
-            cand_idx = (x_possible_actions[i] == order_idx).nonzero()[0, 0]
-            y_actions[i] = cand_idx
-        except IndexError:
-            # filter away powers whose orders are not in valid_orders
-            # most common reasons why this happens:
-            # - actual garbage orders (e.g. moves between non-adjacent locations)
-            # - too many orders (e.g. three build orders with only two allowed builds)
-            return y_actions, False
+    order_idxs.sort(key=_ORDER_TOPO.__getitem__)
 
-    return y_actions, True
+    # find the i-th order among the candidates of step i for all steps at once.
+    # Candidates of a step may repeat an order (e.g. supports to both coasts map
+    # to the same idx), so take the first match of each step.
+    candidates = x_possible_actions.numpy()[: len(order_idxs)]
+    match = candidates == np.array(order_idxs[: len(candidates)], dtype=candidates.dtype)[:, None]
+    found = match.any(axis=1)
+    # number of leading steps whose order was found
+    n_found = len(found) if found.all() else int(found.argmin())
+    y_actions[:n_found] = torch.from_numpy(match.argmax(axis=1)[:n_found])
+
+    # filter away powers whose orders are not in valid_orders
+    # most common reasons why this happens:
+    # - actual garbage orders (e.g. moves between non-adjacent locations)
+    # - too many orders (e.g. three build orders with only two allowed builds)
+    return y_actions, n_found == len(order_idxs)
 
 
 def filter_orders_in_vocab(orders):
@@ -578,49 +790,71 @@ def smarter_order_index(order):
         return ORDER_VOCABULARY_TO_IDX[order]
 
 
-def encode_weighted_sos_scores(game, phase_idx, value_decay_alpha):
-    y_final_scores = torch.zeros(1, 7, dtype=torch.float)
-    phases = game.get_phase_history()
+def encode_all_sq_scores(
+    phases, last_phase_only: bool = False
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Score each phase of a game once, for use by encode_weighted_sos_scores
 
-    if phase_idx == len(phases) - 1:
-        # end of game
-        phase = phases[phase_idx]
-        y_final_scores[0, :] = torch.FloatTensor(
+    If last_phase_only, only the last phase is scored and the scores of the other
+    phases are NaN.
+
+    Returns a tuple:
+    - [L, 7] float tensor, the square score of each power at each phase
+    - [L] bool tensor, true for the last phase of each year. Not all years
+      have a winter adjustment phase.
+    """
+    scored_phases = phases[-1:] if last_phase_only else phases
+    all_sq_scores = torch.full((len(phases), len(POWERS)), float("nan"))
+    all_sq_scores[len(phases) - len(scored_phases) :] = torch.FloatTensor(
+        [
             [
                 compute_game_scores_from_state(p, phase.state).square_score
                 for p in range(len(POWERS))
             ]
-        )
-        return y_final_scores
+            for phase in scored_phases
+        ]
+    ).view(len(scored_phases), len(POWERS))
 
-    # only weight scores at end of year, noting that not all years have a
-    # winter adjustment phase
-    end_of_year_phases = {}
-    for phase in phases:
-        end_of_year_phases[int(phase.name[1:-1])] = phase.name
-    end_of_year_phases = set(end_of_year_phases.values())
-
-    remaining = 1.0
-    weight = 1.0 - value_decay_alpha
-    for phase in phases[phase_idx + 1 :]:
-        if phase.name not in end_of_year_phases:
-            continue
+    end_of_year_phase_idxs = {int(phase.name[1:-1]): i for i, phase in enumerate(phases)}
+    end_of_year_mask = torch.zeros(len(phases), dtype=torch.bool)
+    end_of_year_mask[list(end_of_year_phase_idxs.values())] = True
+
+    return all_sq_scores, end_of_year_mask
 
-        # calculate sos score at this phase
-        sq_scores = torch.FloatTensor(
-            [
-                compute_game_scores_from_state(p, phase.state).square_score
-                for p in range(len(POWERS))
-            ]
-        )
 
-        # accumulate exp. weighted average
-        y_final_scores[0, :] += weight * sq_scores
-        remaining -= weight
-        weight *= value_decay_alpha
+def encode_weighted_sos_scores(
+    all_sq_scores, end_of_year_mask, final_sq_scores, phase_idx, value_decay_alpha
+):
+    """
+    Arguments:
+    - all_sq_scores, end_of_year_mask: as returned by encode_all_sq_scores
+    - final_sq_scores: [7] square scores at the end of the game
+    - phase_idx: int, the index of the phase to encode
+    - value_decay_alpha: decay of the exp. weighted average of future scores
+
+    Returns a [1, 7] float tensor
+    """
+    y_final_scores = torch.zeros(1, 7, dtype=torch.float)
+
+    if phase_idx == len(all_sq_scores) - 1:
+        # end of game
+        y_final_scores[0, :] = all_sq_scores[phase_idx]
+        return y_final_scores
+
+    if value_decay_alpha == 1.0:
+        # all future years have zero weight, so this is just the final score
+        y_final_scores[0, :] = final_sq_scores
+        return y_final_scores
+
+    # exp. weighted average of the scores at the end of each future year
+    future_sq_scores = all_sq_scores[phase_idx + 1 :][end_of_year_mask[phase_idx + 1 :]]
+    weights = (1.0 - value_decay_alpha) * value_decay_alpha ** torch.arange(
+        len(future_sq_scores), dtype=torch.float64
+    )
+    y_final_scores[0, :] = weights.float() @ future_sq_scores
 
     # fill in remaining weight with final score
-    final_sq_scores = torch.FloatTensor(game.get_square_scores())
+    remaining = 1.0 - weights.sum().item()
     y_final_scores[0, :] += remaining * final_sq_scores
 
     return y_final_scores
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import atexit
+import concurrent.futures
 import glob
 import json
 import logging
@@ -18,6 +19,11 @@ from google.protobuf.json_format import MessageToDict
 from torch.utils.data import RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from fairdiplomacy.data.dataset import Dataset, DataFields
 from fairdiplomacy.models.consts import POWERS, SEASONS
 from fairdiplomacy.models.diplomacy_model.load_model import new_model
@@ -94,7 +100,7 @@ def process_batch(
     )
 
     # x_possible_actions = batch['x_possible_actions'].to(device)
-    y_actions = batch["y_actions"].to(device)
+    y_actions = batch["y_actions"].to(device, non_blocking=True)
 
     # reshape and mask out <EOS> tokens from sequences
     y_actions = y_actions[:, : logits.shape[1]].reshape(-1)  # [B * S]
@@ -118,13 +124,13 @@ def process_batch(
     policy_loss = policy_loss_fn(logits, y_actions)
 
     # calculate sum-of-squares value loss
-    y_final_scores = batch["y_final_scores"].to(device).float().squeeze(1)
+    y_final_scores = batch["y_final_scores"].to(device, non_blocking=True).float().squeeze(1)
     value_loss = value_loss_fn(final_sos, y_final_scores)
 
     # a given state appears multiple times in the dataset for different powers,
     # but we always compute the value loss for each power. So we need to reweight
     # the value loss by 1/num_valid_powers
-    value_loss /= batch["valid_power_idxs"].sum(-1, keepdim=True).to(device)
+    value_loss /= batch["valid_power_idxs"].to(device, non_blocking=True).sum(-1, keepdim=True)
 
     return policy_loss, value_loss, sampled_idxs, final_sos
 
@@ -194,6 +200,23 @@ def calculate_split_accuracy_counts(sampled_idxs, batch):
     return counts
 
 
+def _prefetch_batches(dataset, batches):
+    """Yields dataset[batch_idxs] for each of batches.
+
+    The next batch is fetched (and pinned, if the dataset pins memory) in a
+    background thread while the current one is used.
+    """
+    if not batches:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(dataset.__getitem__, batches[0])
+        for i in range(len(batches)):
+            batch = next_batch.result()
+            if i + 1 < len(batches):
+                next_batch = executor.submit(dataset.__getitem__, batches[i + 1])
+            yield batch
+
+
 def validate(net, val_set, policy_loss_fn, value_loss_fn, batch_size, value_loss_weight: float):
     net_device = next(net.parameters()).device
 
@@ -205,9 +228,8 @@ def validate(net, val_set, policy_loss_fn, value_loss_fn, batch_size, value_loss
         batch_acc_split_counts = []
         batch_value_accuracies = []
 
-        for batch_idxs in torch.arange(len(val_set)).split(batch_size):
-            batch = val_set[batch_idxs]
-            batch = DataFields({k: v.to(net_device) for k, v in batch.items()})
+        for batch in _prefetch_batches(val_set, torch.arange(len(val_set)).split(batch_size)):
+            batch = DataFields({k: v.to(net_device, non_blocking=True) for k, v in batch.items()})
             y_actions = batch["y_actions"]
             if y_actions.shape[0] == 0:
                 logger.warning(
@@ -258,6 +280,9 @@ def main_subproc(rank, world_size, args, train_set, val_set, extra_val_datasets)
         mp_setup(rank, world_size)
         atexit.register(mp_cleanup)
         torch.cuda.set_device(rank)
+        if args.pin_memory:
+            for dataset in [train_set, val_set, *extra_val_datasets.values()]:
+                dataset.pin_memory = True
     else:
         assert rank == 0 and world_size == 1
 
@@ -314,8 +339,7 @@ def main_subproc(rank, world_size, args, train_set, val_set, extra_val_datasets)
         batches = torch.tensor(list(iter(train_set_sampler)), dtype=torch.long).split(
             args.batch_size
         )
-        for batch_i, batch_idxs in enumerate(batches):
-            batch = train_set[batch_idxs]
+        for batch_i, batch in enumerate(_prefetch_batches(train_set, batches)):
             logger.debug(f"Zero grad {batch_i} ...")
 
             # check batch is not empty
@@ -588,8 +612,13 @@ def get_sl_db_args(metadata_path, min_rating_percentile, max_games, val_set_pct)
     :param val_set_pct:
     :return: game_metadata, min_rating, train_game_ids and val_game_ids
     """
-    with open(metadata_path) as meta_f:
-        game_metadata = json.load(meta_f)
+    if orjson is not None:
+        # the metadata of all games is a large json, orjson parses it several times faster
+        with open(metadata_path, "rb") as meta_f:
+            game_metadata = orjson.loads(meta_f.read())
+    else:
+        with open(metadata_path) as meta_f:
+            game_metadata = json.load(meta_f)
     # convert to int game keys
     game_metadata = {int(k): v for k, v in game_metadata.items()}
     game_ids = list(game_metadata.keys())
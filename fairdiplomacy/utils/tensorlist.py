@@ -110,6 +110,20 @@ class TensorList(object):
         else:
             raise KeyError("Unknown index type: %s" % type(index))
 
+    def select_blocks(self, block_index, block_size):
+        """Select whole blocks of block_size consecutive elements.
+
+        Equivalent to indexing by the LongTensor
+            (block_index * block_size).unsqueeze(1) + torch.arange(block_size)
+        flattened, but without building that index.
+        """
+        assert len(self) % block_size == 0
+        offsets_sub = self.offsets[:-1].reshape(-1, block_size)[block_index].view(-1)
+        ends_sub = self.offsets[1:].reshape(-1, block_size)[block_index].view(-1)
+        new_offsets, new_data = _extract_intervals(offsets_sub, ends_sub - offsets_sub, self.data)
+
+        return TensorList(new_offsets, new_data)
+
     def __eq__(self, other):
         if not isinstance(other, TensorList):
             return NotImplemented
@@ -0,0 +1,47 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Tests for HeyHi utils.
+
+Run with nosetests.
+"""
+import pathlib
+import tempfile
+import unittest
+
+import heyhi.util
+
+
+class TestParallelRmtree(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _make_tree(self, path, num_entries):
+        path.mkdir()
+        for i in range(num_entries):
+            if i % 2:
+                (path / f"file{i}").write_text("data")
+            else:
+                (path / f"dir{i}").mkdir()
+                (path / f"dir{i}" / "file").write_text("data")
+
+    def testRemovesBigTree(self):
+        path = self.root / "exp"
+        self._make_tree(path, 40)
+        heyhi.util._parallel_rmtree(path)
+        self.assertFalse(path.exists())
+
+    def testKeepsSymlinkTarget(self):
+        target = self.root / "target"
+        self._make_tree(target, 40)
+        path = self.root / "exp"
+        path.symlink_to(target, target_is_directory=True)
+        with self.assertRaises(OSError):
+            heyhi.util._parallel_rmtree(path)
+        self.assertEqual(len(list(target.iterdir())), 40)
@@ -5,18 +5,22 @@
 
 from os.path import exists
 from typing import Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+import concurrent.futures
 import datetime
 import enum
 import hashlib
 import functools
+import json
 import logging
 import os
 import pathlib
+import re
 import shutil
 import signal
 import subprocess
 import socket
 import sys
+import tempfile
 import time
 
 import torch
@@ -42,25 +46,46 @@ JOBFILE_NAME = "heyhi.jobid"
 RESULTFILE_NAME = "result.torch"
 DELIMETER = "@"
 LOCAL_JOB_ID = "local"
+# Matches a component of an override key, capturing its first 3 chars.
+_KEY_COMPONENT_RE = re.compile(r"([^.]{1,3})[^.]*")
+# How long (in seconds) squeue output cached on disk stays valid, unless
+# HEYHI_SQUEUE_TTL is set. The cache is shared by all heyhi processes of the user.
+DEFAULT_SQUEUE_CACHE_TTL = 10.0
 _SLURM_CACHE = {}
+# Shared by all handlers set up by setup_logging().
+_LOG_FORMATTER = logging.Formatter(
+    fmt=("%(levelname)s%(asctime)s" " [%(module)s:%(lineno)d] %(message)s"),
+    datefmt="%m%d %H:%M:%S",
+)
 
 
 def reset_slurm_cache():
     global _SLURM_CACHE
     _SLURM_CACHE.clear()
+    _reset_env_cache()
+
+
+def _reset_env_cache():
+    # The slurm env of the process is read once, see is_on_slurm() and co.
+    is_on_slurm.cache_clear()
+    get_slurm_job_id.cache_clear()
+    is_master.cache_clear()
 
 
 def get_slurm_master():
-    hostnames = subprocess.check_output(
-        ["scontrol", "show", "hostnames", os.environ["SLURM_JOB_NODELIST"]]
-    )
+    return _get_first_hostname(os.environ["SLURM_JOB_NODELIST"])
+
+
+@functools.lru_cache(maxsize=1)
+def _get_first_hostname(nodelist: str) -> str:
+    hostnames = subprocess.check_output(["scontrol", "show", "hostnames", nodelist])
     return hostnames.split()[0].decode("utf-8")
 
 
 def requeue_myself():
     job_id = get_slurm_job_id()
     logging.warning("Requeuing job %s", job_id)
-    os.system("scontrol requeue %s" % job_id)
+    subprocess.run(["scontrol", "requeue", job_id], check=False)
 
 
 def term_handler(signum, frame):
@@ -90,35 +115,45 @@ def setup_logging(
     logging.addLevelName(logging.ERROR, "E")
     logging.addLevelName(logging.CRITICAL, "C")
 
-    formatter = logging.Formatter(
-        fmt=("%(levelname)s%(asctime)s" " [%(module)s:%(lineno)d] %(message)s"),
-        datefmt="%m%d %H:%M:%S",
-    )
-
     logger = logging.getLogger()
-    for x in logger.handlers[:]:
-        logger.removeHandler(x)
-    for x in logger.filters[:]:
-        logger.removeFilter(x)
+    # Keep the file handler if we are already logging to fpath.
+    file_handler = None
+    if fpath is not None:
+        fpath = os.path.abspath(fpath)
+        for handler in logger.handlers:
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename == fpath:
+                file_handler = handler
+    logger.handlers.clear()
+    logger.filters.clear()
     logger.setLevel(logging.DEBUG)
     logger.propagate = False
 
     if console_level is not None:
         console_handler = logging.StreamHandler()
         console_handler.setLevel(console_level)
-        console_handler.setFormatter(formatter)
+        console_handler.setFormatter(_LOG_FORMATTER)
         logger.addHandler(console_handler)
 
     if fpath is not None:
-        file_handler = logging.FileHandler(fpath)
+        if file_handler is None:
+            file_handler = logging.FileHandler(fpath)
         file_handler.setLevel(file_level)
-        file_handler.setFormatter(formatter)
+        file_handler.setFormatter(_LOG_FORMATTER)
         logger.addHandler(file_handler)
 
     return logger
 
 
 def log_git_status():
+    """Logs the git revision and saves the diff of the tree to workdir.diff.
+
+    Skipped on CI and in tests. Set HEYHI_SKIP_GIT_LOG to skip it elsewhere.
+    """
+    if not is_master():
+        return
+    if any(x in os.environ for x in ("CIRCLECI", "PYTEST_CURRENT_TEST", "HEYHI_SKIP_GIT_LOG")):
+        # Not worth a git diff of the whole tree in tests.
+        return
     git_repo = str(pathlib.Path(__file__).resolve().parent.parent)
     try:
         rev = subprocess.check_output("git rev-parse HEAD".split(), cwd=git_repo)
@@ -126,31 +161,62 @@ def log_git_status():
         logging.error("Attempt to call 'git rev-parse HEAD' failed: %s", e)
     else:
         logging.info("Git revision: %s", rev.decode("utf8").strip())
+    # Stream the diff straight to the file, and drop the file if it's empty.
+    diff_path = pathlib.Path("workdir.diff").resolve()
     try:
-        diff = subprocess.check_output("git diff HEAD".split(), cwd=git_repo)
+        with diff_path.open("w") as stream:
+            subprocess.check_call("git diff HEAD".split(), cwd=git_repo, stdout=stream)
     except subprocess.CalledProcessError as e:
         logging.error("Failed to call 'git diff HEAD': %s", e)
+        diff_path.unlink()
     else:
-        if diff:
-            diff_path = pathlib.Path("workdir.diff").resolve()
-            if is_master():
-                logging.info("Found unsubmitited diff. Saving to %s", diff_path)
-                with diff_path.open("w") as stream:
-                    stream.write(diff.decode("utf8"))
-            else:
-                logging.info("Found unsubmitited diff. NOT saving as not the master.")
+        if diff_path.stat().st_size:
+            logging.info("Found unsubmitited diff. Saved to %s", diff_path)
         else:
             logging.info("No diff in the working copy")
+            diff_path.unlink()
+
+
+def _get_squeue_cache_path(user_only: bool) -> pathlib.Path:
+    # A per-user dir rather than /tmp, so other users can't plant or read the cache.
+    cache_dir = pathlib.Path.home() / ".cache" / "heyhi"
+    return cache_dir / ("squeue_user.json" if user_only else "squeue.json")
+
+
+def _get_squeue_cache_ttl() -> float:
+    ttl = os.environ.get("HEYHI_SQUEUE_TTL")
+    if ttl is None:
+        return DEFAULT_SQUEUE_CACHE_TTL
+    try:
+        return float(ttl)
+    except ValueError:
+        logging.warning("Bad HEYHI_SQUEUE_TTL=%r. Using %s instead", ttl, DEFAULT_SQUEUE_CACHE_TTL)
+        return DEFAULT_SQUEUE_CACHE_TTL
 
 
 def _get_all_runing_job_ids(user_only: bool = False) -> FrozenSet[str]:
     if "CIRCLECI" in os.environ:
         return frozenset([])
+    cache_path = _get_squeue_cache_path(user_only)
+    try:
+        if time.time() - cache_path.stat().st_mtime < _get_squeue_cache_ttl():
+            with cache_path.open() as stream:
+                return frozenset(json.load(stream))
+    except (OSError, ValueError):
+        pass  # No usable cache. Call squeue.
     cmd = ["squeue", "-r", "-h", "-o", "%i"]
     if user_only:
         cmd.extend(["-u", os.environ["USER"]])
-    output = subprocess.check_output(cmd)
-    job_ids = output.decode("utf8").split()
+    output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+    job_ids = output.split()
+    try:
+        cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as stream:
+            json.dump(job_ids, stream)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning("Failed to cache squeue output in %s: %s", cache_path, e)
     return frozenset(job_ids)
 
 
@@ -168,17 +234,21 @@ class Status(enum.IntEnum):
     RUNNING = 4
 
 
+@functools.lru_cache(maxsize=1)
 def is_on_slurm() -> bool:
     return "SLURM_PROCID" in os.environ
 
 
+@functools.lru_cache(maxsize=1)
 def get_slurm_job_id() -> Optional[str]:
-    if "SLURM_ARRAY_JOB_ID" in os.environ:
-        return "%s_%s" % (os.environ["SLURM_ARRAY_JOB_ID"], os.environ["SLURM_ARRAY_TASK_ID"])
-    else:
-        return os.environ["SLURM_JOB_ID"]
+    env = os.environ
+    array_job_id = env.get("SLURM_ARRAY_JOB_ID")
+    if array_job_id is not None:
+        return f"{array_job_id}_{env['SLURM_ARRAY_TASK_ID']}"
+    return env.get("SLURM_JOB_ID")
 
 
+@functools.lru_cache(maxsize=1)
 def is_master() -> bool:
     return os.environ.get("SLURM_PROCID", "0") == "0"
 
@@ -217,18 +287,20 @@ class ExperimentDir:
             print(job_id, file=stream)
 
     def get_status(self) -> Status:
-        if not self.job_id_path.exists():
-            if self.exp_path.exists():
-                logging.warning("Experiment folder without job_id file: %s", self.exp_path)
+        # List the folder once rather than checking each file separately.
+        try:
+            with os.scandir(self.exp_path) as it:
+                file_names = frozenset(entry.name for entry in it)
+        except (FileNotFoundError, NotADirectoryError):
             return Status.NOT_STARTED
-        maybe_jobid = self.maybe_get_job_id()
-        if (
-            maybe_jobid is not None
-            and maybe_jobid != LOCAL_JOB_ID
-            and maybe_jobid in get_all_runing_job_ids()
-        ):
+        if JOBFILE_NAME not in file_names:
+            logging.warning("Experiment folder without job_id file: %s", self.exp_path)
+            return Status.NOT_STARTED
+        with self.job_id_path.open() as stream:
+            jobid = stream.read().strip()
+        if jobid != LOCAL_JOB_ID and jobid in get_all_runing_job_ids():
             return Status.RUNNING
-        if self.result_path.exists():
+        if RESULTFILE_NAME in file_names:
             return Status.DONE
         return Status.DEAD
 
@@ -246,10 +318,8 @@ class ExperimentDir:
             return
         logging.info("Prune+kill for %s", self.exp_path)
         if not silent:
-            print("Deleting the folder in 3 seconds", end="", flush=True)
-            for _ in range(3):
-                print(".", end="", flush=True)
-                time.sleep(1)
+            print("Deleting the folder in 3 seconds...", end="", flush=True)
+            time.sleep(3)
         maybe_jobid = self.maybe_get_job_id()
         if maybe_jobid is not None and maybe_jobid != LOCAL_JOB_ID:
             if not silent:
@@ -257,7 +327,7 @@ class ExperimentDir:
             subprocess.check_call(["scancel", str(maybe_jobid)])
         if not silent:
             print(" purging the log dir", "...", end="", flush=True)
-        shutil.rmtree(str(self.exp_path))
+        _parallel_rmtree(self.exp_path)
         if not silent:
             print("done")
 
@@ -266,6 +336,30 @@ class ExperimentDir:
         return self.exp_path / "slurm"
 
 
+def _parallel_rmtree(path: pathlib.Path, max_workers: int = 16) -> None:
+    """Like shutil.rmtree, but removes top-level entries in parallel threads."""
+    if path.is_symlink():
+        # Let shutil.rmtree refuse it rather than delete the contents of the target.
+        shutil.rmtree(str(path))
+        return
+    with os.scandir(path) as it:
+        entries = list(it)
+    if len(entries) < 32:
+        shutil.rmtree(str(path))
+        return
+
+    def remove(entry):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        # Consume the results to re-raise any errors.
+        list(executor.map(remove, entries))
+    os.rmdir(path)
+
+
 def save_result_in_cwd(f):
     """Save results of the function to a results.torch file in cwd."""
 
@@ -275,7 +369,10 @@ def save_result_in_cwd(f):
         result_path = os.path.join(os.getcwd(), RESULTFILE_NAME)
         if is_master():
             logging.info("Saving result to %s", result_path)
-            torch.save(result, result_path)
+            # The result file marks the experiment as done, so write it atomically.
+            tmp_path = f"{result_path}.{os.getpid()}.tmp"
+            torch.save(result, tmp_path)
+            os.replace(tmp_path, result_path)
         return result
 
     return wrapped
@@ -283,7 +380,11 @@ def save_result_in_cwd(f):
 
 def _get_config_folder_tag(path: pathlib.Path) -> str:
     assert path.exists(), path
-    config_path = str(path.parent.absolute())
+    return _get_config_dir_tag(str(path.parent.absolute()))
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_config_dir_tag(config_path: str) -> str:
     if config_path.startswith(str(conf.CONF_ROOT)):
         components = config_path[len(str(conf.CONF_ROOT)) :].strip("/").split("/")
         if components:
@@ -297,22 +398,23 @@ def _get_config_folder_tag(path: pathlib.Path) -> str:
 
 
 def _get_overrides_tags(overrides: Sequence[str]) -> Tuple[str, str]:
-    def sort_key(override):
-        name = override.split("=")[0]
-        depth = len(name.split("."))
-        return (depth, name, override)
+    # Sort by (depth, name, override), splitting each override only once.
+    decorated = []
+    for override in overrides:
+        key, value = override.split("=", 1)
+        decorated.append(((key.count(".") + 1, key, override), value))
+    decorated.sort(key=lambda x: x[0])
 
-    overrides = sorted(overrides, key=sort_key)
+    overrides = [sort_key[2] for sort_key, _ in decorated]
     hashtag = hashlib.md5(repr(overrides).encode("utf8")).hexdigest()[:8]
     parsed_overrides = []
-    for override in overrides:
-        key, value = override.split("=", 1)
+    for (_, key, _), value in decorated:
         if len(key) > 5:
             # Compress key.
-            key = ".".join(x[:3] for x in key.split("."))
+            key = _KEY_COMPONENT_RE.sub(r"\1", key)
         if "/" in value:
             # For paths, use the last 2 components.
-            value = "_".join(value.split("/")[-2:])
+            value = "_".join(value.rsplit("/", 2)[-2:])
         value = value.replace(" ", "_")
         parsed_overrides.append(f"{key}{DELIMETER}{value}")
     override_tag = DELIMETER.join(parsed_overrides)[:MAX_OVERRIDE_LEN]
@@ -415,13 +517,26 @@ def run_with_config(
         launcher_cfg = None
     assert launcher_type in ("local", "slurm"), launcher_type
 
-    conf.save_config(meta_cfg, pathlib.Path("config_meta.prototxt"))
-    conf.save_config(cfg, pathlib.Path("config.prototxt"))
+    # Write the configs in the background while the task starts. Save a copy, as
+    # the task may modify its config.
+    meta_cfg_copy = type(meta_cfg)()
+    meta_cfg_copy.CopyFrom(meta_cfg)
+    cwd = pathlib.Path.cwd()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    futures = [
+        executor.submit(conf.save_config, meta_cfg_copy, cwd / "config_meta.prototxt"),
+        executor.submit(conf.save_config, getattr(meta_cfg_copy, task), cwd / "config.prototxt"),
+    ]
 
-    callable = functools.partial(task_function, cfg=cfg, task=task)
-    if launcher_type == "slurm" and not is_on_slurm():
-        raise NotImplementedError()
-    else:
-        exp_handle.save_job_id(LOCAL_JOB_ID)
-        callable()
+    try:
+        callable = functools.partial(task_function, cfg=cfg, task=task)
+        if launcher_type == "slurm" and not is_on_slurm():
+            raise NotImplementedError()
+        else:
+            exp_handle.save_job_id(LOCAL_JOB_ID)
+            callable()
+    finally:
+        executor.shutdown(wait=True)
+    for future in futures:
+        future.result()  # Re-raise errors, if any.
     os.chdir(old_cwd)
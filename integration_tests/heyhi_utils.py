@@ -29,10 +29,12 @@ def run_config(
     cmd.extend(overrides)
 
     print("Cmd:")
-    print(f"HH_EXP_DIR={OUTPUT_ROOT}", *cmd)
+    print(f"HH_EXP_DIR={OUTPUT_ROOT}", "HEYHI_SKIP_GIT_LOG=1", *cmd)
 
     env = os.environ.copy()
     env["HH_EXP_DIR"] = str(OUTPUT_ROOT)
+    # Don't save a git diff of the whole tree for every test run.
+    env["HEYHI_SKIP_GIT_LOG"] = "1"
     if "USER" not in env:
         # Weird CI stuff.
         env["USER"] = "root"
@@ -9,6 +9,7 @@ Note: on devfair some extra test cases will be enabled that use real data.
 
 Use `notetest <path>` to execute this file.
 """
+import functools
 import unittest
 
 from parameterized import parameterized
@@ -28,15 +29,18 @@ def _load_task_cfg(cfg_path, overides=tuple()):
     return getattr(cfg, task_name)
 
 
-def _create_supervised_model(sup_model_path):
+@functools.lru_cache(maxsize=None)
+def _get_supervised_model_path():
+    """Creates a small supervised model once and returns the path to it."""
+    sup_model_path = TMP_DIR / "sup_model_shared.pth"
     sup_model_path.parent.mkdir(exist_ok=True, parents=True)
     sl_cfg = _load_task_cfg(
         heyhi.CONF_ROOT / "c02_sup_train" / "sl.prototxt", ["num_encoder_blocks=1"]
     )
     model = fairdiplomacy.models.diplomacy_model.load_model.new_model(sl_cfg)
     ckpt = {"model": model.state_dict(), "args": sl_cfg}
-    print(model)
     torch.save(ckpt, sup_model_path)
+    return sup_model_path
 
 
 @parameterized([("sl.prototxt",), ("sl_20200717.prototxt",)])
@@ -49,8 +53,7 @@ def test_train_configs(cfg_name):
 
 @parameterized([("exploit_06.prototxt",), ("selfplay_01.prototxt",)])
 def test_rl_configs(cfg_name):
-    sup_model_path = TMP_DIR / "sup_model_for_rl.pth"
-    _create_supervised_model(sup_model_path)
+    sup_model_path = _get_supervised_model_path()
 
     integration_tests.heyhi_utils.run_config(
         cfg=heyhi.CONF_ROOT / "c04_exploit" / cfg_name,
@@ -75,8 +78,7 @@ def test_build_cache():
 
 
 def test_compare_agents():
-    out_path = TMP_DIR / "c01_ag_cmp" / "model.pth"
-    _create_supervised_model(out_path)
+    out_path = _get_supervised_model_path()
     integration_tests.heyhi_utils.run_config(
         cfg=heyhi.CONF_ROOT / "c01_ag_cmp" / "cmp.prototxt",
         overrides=[
@@ -90,8 +92,7 @@ def test_compare_agents():
 
 
 def test_compare_agents_single_cfr():
-    out_path = TMP_DIR / "c01_ag_cmp" / "model.pth"
-    _create_supervised_model(out_path)
+    out_path = _get_supervised_model_path()
     integration_tests.heyhi_utils.run_config(
         cfg=heyhi.CONF_ROOT / "c01_ag_cmp" / "cmp.prototxt",
         overrides=[
@@ -6,18 +6,15 @@
 import logging
 import os
 import json
-import torch
-import numpy as np
-
-from fairdiplomacy.agents import build_agent_from_cfg
-from fairdiplomacy.compare_agents import run_1v6_trial, run_1v6_trial_multiprocess
-from fairdiplomacy.models.diplomacy_model import train_sl
-from fairdiplomacy.situation_check import run_situation_check
 
 import heyhi
 import conf.conf_pb2
 
+# Maps CompareAgentsTask.Power values to power names.
+_POWER_NAMES = {value: name for name, value in conf.conf_pb2.CompareAgentsTask.Power.items()}
 
+# Tasks import what they need when called, so that launching a task doesn't
+# pay for importing the dependencies of all the others.
 TASKS = {}
 
 
@@ -28,6 +25,10 @@ def _register(f):
 
 @_register
 def compare_agents(cfg):
+    import numpy as np
+    import torch
+    from fairdiplomacy.agents import build_agent_from_cfg
+    from fairdiplomacy.compare_agents import run_1v6_trial, run_1v6_trial_multiprocess
 
     # NEED TO SET THIS BEFORE CREATING THE AGENT!
     if cfg.seed >= 0:
@@ -42,11 +43,7 @@ def compare_agents(cfg):
     else:
         cf_agent = None
 
-    def _power_to_string(power_id):
-        power_enum = conf.conf_pb2.CompareAgentsTask.Power
-        return dict(zip(power_enum.values(), power_enum.keys()))[power_id]
-
-    power_string = _power_to_string(cfg.power_one)
+    power_string = _POWER_NAMES[cfg.power_one]
 
     kwargs = dict(
         start_game=cfg.start_game,
@@ -85,6 +82,8 @@ def compare_agents(cfg):
 
 @_register
 def train(cfg):
+    from fairdiplomacy.models.diplomacy_model import train_sl
+
     train_sl.run_with_cfg(cfg)
 
 
@@ -105,6 +104,10 @@ def build_db_cache(cfg):
 
 @_register
 def situation_check(cfg):
+    import numpy as np
+    import torch
+    from fairdiplomacy.agents import build_agent_from_cfg
+    from fairdiplomacy.situation_check import run_situation_check
 
     # NEED TO SET THIS BEFORE CREATING THE AGENT!
     if cfg.seed >= 0:
@@ -142,6 +145,7 @@ def benchmark_agent(cfg):
 
 @_register
 def compute_xpower_statistics(cfg):
+    from fairdiplomacy.agents import build_agent_from_cfg
     from fairdiplomacy.get_xpower_supports import compute_xpower_statistics, get_game_paths
 
     paths = get_game_paths(
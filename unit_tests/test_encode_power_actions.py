@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+import unittest
+import torch
+
+from fairdiplomacy.data.dataset import (
+    _ORDER_TOPO,
+    encode_power_actions,
+    smarter_order_index,
+)
+from fairdiplomacy.models.consts import MAX_SEQ_LEN
+from fairdiplomacy.models.diplomacy_model.order_vocabulary import EOS_IDX
+from fairdiplomacy.utils.order_idxs import MAX_VALID_LEN, ORDER_VOCABULARY
+
+
+def _encode_power_actions_reference(orders, x_possible_actions):
+    """Loop version of encode_power_actions for non-build orders."""
+    y_actions = torch.empty(MAX_SEQ_LEN, dtype=torch.int32).fill_(EOS_IDX)
+    order_idxs = sorted(
+        (smarter_order_index(order) for order in orders), key=_ORDER_TOPO.__getitem__
+    )
+    for i, order_idx in enumerate(order_idxs):
+        try:
+            y_actions[i] = x_possible_actions[i].tolist().index(order_idx)
+        except (IndexError, ValueError):
+            return y_actions, False
+    return y_actions, True
+
+
+def _get_orders_with_distinct_locs(rng, n):
+    by_loc = {}
+    for order in ORDER_VOCABULARY:
+        split_order = order.split()
+        if ";" not in order and split_order[2] != "B":
+            by_loc.setdefault(split_order[1], []).append(order)
+    return [rng.choice(by_loc[loc]) for loc in rng.sample(sorted(by_loc), n)]
+
+
+class TestEncodePowerActions(unittest.TestCase):
+    def _check(self, orders, x_possible_actions):
+        y_actions, valid = encode_power_actions(orders, x_possible_actions)
+        y_actions_ref, valid_ref = _encode_power_actions_reference(orders, x_possible_actions)
+        self.assertEqual(valid, valid_ref)
+        self.assertEqual(y_actions.tolist(), y_actions_ref.tolist())
+        return y_actions, valid
+
+    def test_duplicate_candidates(self):
+        # e.g. dipcc emits supports into both SPA/NC and SPA, which map to one idx
+        orders = _get_orders_with_distinct_locs(random.Random(0), 2)
+        order_idxs = sorted(map(smarter_order_index, orders), key=_ORDER_TOPO.__getitem__)
+        x_possible_actions = torch.full((MAX_SEQ_LEN, MAX_VALID_LEN), EOS_IDX, dtype=torch.long)
+        x_possible_actions[0, :2] = order_idxs[0]
+        x_possible_actions[1, :3] = torch.tensor([5, order_idxs[1], order_idxs[1]])
+
+        y_actions, valid = self._check(orders, x_possible_actions)
+        self.assertTrue(valid)
+        self.assertEqual(y_actions[:3].tolist(), [0, 1, EOS_IDX])
+
+    def test_random_candidates(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            orders = _get_orders_with_distinct_locs(rng, rng.randint(1, 5))
+            order_idxs = sorted(map(smarter_order_index, orders), key=_ORDER_TOPO.__getitem__)
+            x_possible_actions = torch.full(
+                (MAX_SEQ_LEN, MAX_VALID_LEN), EOS_IDX, dtype=torch.long
+            )
+            for i, order_idx in enumerate(order_idxs):
+                candidates = [rng.randrange(len(ORDER_VOCABULARY)) for _ in range(4)]
+                if rng.random() < 0.9:
+                    candidates += [order_idx] * rng.randint(1, 2)
+                rng.shuffle(candidates)
+                x_possible_actions[i, : len(candidates)] = torch.tensor(candidates)
+            self._check(orders, x_possible_actions)
@@ -0,0 +1,48 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import tempfile
+import unittest
+from unittest import mock
+import torch
+
+import fairdiplomacy.data.dataset as dataset
+from fairdiplomacy.data.data_fields import DataFields
+from fairdiplomacy.models.consts import POWERS
+from fairdiplomacy.utils.tensorlist import TensorList
+
+
+def _make_encoded_game():
+    return DataFields(
+        x_board_state=torch.rand(3, 81, 35) > 0.5,
+        y_final_scores=torch.rand(3, 1, 7),
+        x_possible_actions=TensorList.from_padded(torch.arange(12).view(3, 4), padding_value=-1),
+    )
+
+
+class TestEncodingCache(unittest.TestCase):
+    def test_write_then_read(self):
+        encoded_game = _make_encoded_game()
+        game_metadata = {0: {pwr: {"logit_rating": 0.0} for pwr in POWERS}}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            dataset._set_encode_worker_inputs(
+                game_metadata, dict(min_rating=-1.0, encoding_cache_dir=cache_dir)
+            )
+            try:
+                with mock.patch.object(dataset, "encode_game", return_value=(0, encoded_game)):
+                    dataset._encode_game_in_worker(0)
+                # the second call must be served from the cache
+                with mock.patch.object(dataset, "encode_game", side_effect=AssertionError):
+                    game_id, cached_game = dataset._encode_game_in_worker(0)
+            finally:
+                dataset._set_encode_worker_inputs(None, None)
+
+        self.assertEqual(game_id, 0)
+        self.assertIsInstance(cached_game, DataFields)
+        self.assertEqual(cached_game.keys(), encoded_game.keys())
+        self.assertIsInstance(cached_game["x_possible_actions"], TensorList)
+        self.assertEqual(cached_game["x_possible_actions"], encoded_game["x_possible_actions"])
+        for k in ("x_board_state", "y_final_scores"):
+            self.assertTrue(torch.equal(cached_game[k], encoded_game[k]), k)